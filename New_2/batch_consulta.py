@@ -9,9 +9,14 @@ import io
 import random
 import threading
 import hashlib
+import bisect
+import operator
 import os
 import csv
+import sqlite3
 import unicodedata
+import orjson
+import xlsxwriter
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from zoneinfo import ZoneInfo
@@ -59,7 +64,9 @@ URL_IBGE_MUNS      = "https://servicodados.ibge.gov.br/api/v1/localidades/estado
 BRASILIA_TZ = ZoneInfo("America/Sao_Paulo")
 
 # Parâmetros
-MAX_WORKERS    = 3
+# O ritmo é ditado pelo limiter (slots reservados), não pelo nº de threads: workers
+# extras só cobrem respostas lentas enquanto outros slots já são liberados.
+MAX_WORKERS    = 6
 START_INTERVAL = 1.0
 
 # Limitador adaptativo
@@ -67,6 +74,7 @@ MIN_INTERVAL_FLOOR = 0.75
 MIN_INTERVAL_CEIL  = 5.0
 ADAPT_SUCC_WINDOW  = 18
 ADAPT_FAIL_BACKOFF = 2.0
+ADAPT_RATE_STEP    = 0.1   # req/s somados à taxa a cada janela de sucessos (AIMD)
 
 # Robustez
 TOTAL_RETRIES = 3
@@ -75,6 +83,10 @@ REQ_TIMEOUT   = 20
 # Limites
 MAX_INPUTS = 1000
 
+# UI
+UI_REFRESH_SECONDS = 0.5
+PREVIEW_TAIL_ROWS = 100  # prévia durante o lote: só as últimas linhas
+
 # Autosave
 AUTOSAVE_BLOCK = 10
 OUTPUT_DIR = "autosave_cnpj"
@@ -89,56 +101,156 @@ CSV_COLS = [
     "Codigo IBGE Municipio","TIMESTAMP"
 ]
 
-# ---------- Cache global (thread-safe) ----------
-_CACHE: Dict[str, Dict[str, Any]] = {}
-_CACHE_LOCK = threading.Lock()
+# ---------- Cache persistente (SQLite, thread-safe) ----------
+# Guarda o JSON bruto da BrasilAPI (não a linha montada), então mudanças no layout
+# do CSV não invalidam o cache. Sobrevive a reinícios do Streamlit.
+CACHE_DB_PATH = os.path.join(OUTPUT_DIR, "cache_cnpj.sqlite3")
+CACHE_TTL_SECONDS = 30 * 24 * 3600
+
+@st.cache_resource
+def _abrir_cache_db() -> Tuple[sqlite3.Connection, threading.Lock]:
+    """Conexão única por processo: o Streamlit reexecuta o script a cada rerun, então um
+    global comum reabriria (e vazaria) a conexão a cada lote. O lock vem junto porque
+    todas as sessões passam a dividir a mesma conexão."""
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    conn = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, isolation_level=None)
+    # WAL: leitura não espera escrita (várias abas/sessões no mesmo arquivo) e cada
+    # INSERT em autocommit vira um append no log em vez de reescrever páginas.
+    # synchronous=NORMAL basta: perder o último registro numa queda de energia só
+    # custa refazer uma consulta.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cnpj_cache ("
+        "cnpj TEXT PRIMARY KEY, fetched_at REAL NOT NULL, payload BLOB NOT NULL)"
+    )
+    return conn, threading.Lock()
+
+# Resolvido aqui, na thread do script: os workers só usam os objetos já prontos.
+try:
+    _CACHE_DB, _CACHE_LOCK = _abrir_cache_db()
+except Exception:
+    # Sem disco gravável o lote segue sem cache: cache_get/cache_set engolem o erro
+    _CACHE_DB, _CACHE_LOCK = None, threading.Lock()
 
 def cache_get(cnpj_key: str) -> Optional[Dict[str, Any]]:
-    with _CACHE_LOCK:
-        return _CACHE.get(cnpj_key)
+    try:
+        with _CACHE_LOCK:
+            hit = _CACHE_DB.execute(
+                "SELECT payload FROM cnpj_cache WHERE cnpj = ? AND fetched_at >= ?",
+                (cnpj_key, time.time() - CACHE_TTL_SECONDS)
+            ).fetchone()
+        return orjson.loads(hit[0]) if hit else None
+    except Exception:
+        return None
 
 def cache_set(cnpj_key: str, data: Dict[str, Any]) -> None:
-    with _CACHE_LOCK:
-        _CACHE[cnpj_key] = data
-
-# ---------- Pool de sessões por thread ----------
-_thread_local = threading.local()
+    try:
+        payload = orjson.dumps(data)
+        with _CACHE_LOCK:
+            _CACHE_DB.execute(
+                "INSERT OR REPLACE INTO cnpj_cache (cnpj, fetched_at, payload) VALUES (?, ?, ?)",
+                (cnpj_key, time.time(), payload)
+            )
+    except Exception:
+        pass
+
+# ---------- Sessão HTTP compartilhada (keep-alive) ----------
+# Uma única Session para todos os workers do lote: o pool do urllib3 é thread-safe,
+# então conexões TCP/TLS abertas por uma thread são reaproveitadas pelas demais.
+# Como o Streamlit reexecuta o script a cada rerun, ela vale por execução, não por processo.
+_SESSION = requests.Session()
+# pool_connections = nº de hosts (BrasilAPI + IBGE); pool_maxsize = nº de workers,
+# que é o máximo de conexões simultâneas por host. pool_block: se algum dia houver
+# mais threads que conexões, a thread espera uma livre em vez de abrir uma conexão
+# avulsa (novo handshake TLS) que seria descartada depois.
+_adapter = HTTPAdapter(
+    pool_connections=2,
+    pool_maxsize=MAX_WORKERS,
+    pool_block=True,
+    max_retries=Retry(total=0, backoff_factor=0, status_forcelist=[])
+)
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+_SESSION.headers.update({"Accept": "application/json", "User-Agent": "pricetax-cnpj-lote/1.0"})
 
 def get_session() -> requests.Session:
-    s = getattr(_thread_local, "session", None)
-    if s is None:
-        s = requests.Session()
-        adapter = HTTPAdapter(
-            pool_connections=MAX_WORKERS * 2,
-            pool_maxsize=MAX_WORKERS * 4,
-            max_retries=Retry(total=0, backoff_factor=0, status_forcelist=[])
-        )
-        s.mount("http://", adapter)
-        s.mount("https://", adapter)
-        _thread_local.session = s
-    return s
+    return _SESSION
 
 # =========================
 # Helpers (CNPJ, CNAE, etc.)
 # =========================
+# str.translate só apaga o que está na tabela: fica restrito a ASCII (caso comum);
+# qualquer outro caractere (ex.: travessão colado do Word) cai no regex pré-compilado.
+_ASCII_NAO_DIGITOS = str.maketrans("", "", "".join(chr(c) for c in range(128) if not 48 <= c <= 57))
+_NON_DIGIT_RE = re.compile(r'[^0-9]')
+# Separadores da caixa de texto: ',' e ';' viram espaço e str.split() cuida de todo whitespace
+_SEPARADORES = str.maketrans(",;", "  ")
+
 def limpar_cnpj(cnpj: str) -> str:
-    return re.sub(r'[^0-9]', '', cnpj or "")
+    cnpj = cnpj or ""
+    if cnpj.isascii():
+        return cnpj.translate(_ASCII_NAO_DIGITOS)
+    return _NON_DIGIT_RE.sub('', cnpj)
 
 def cnpj_is_valid(cnpj14: str) -> bool:
     if not cnpj14 or len(cnpj14) != 14 or len(set(cnpj14)) == 1:
         return False
     return cnpj14[-2:] == calcular_digitos_verificadores_cnpj(cnpj14[:12])
 
+# Pesos do DV (criados uma vez; tuplas no caminho escalar, arrays no vetorizado)
+_PESOS_12 = (5,4,3,2,9,8,7,6,5,4,3,2)
+_PESOS_13 = (6,) + _PESOS_12
+_PESOS_12_NP = np.array(_PESOS_12, dtype=np.int64)
+_PESOS_13_NP = np.array(_PESOS_13, dtype=np.int64)
+
+def _digitos_np(cnpjs: List[str], largura: int) -> np.ndarray:
+    """(N, largura) de dígitos a partir de strings ASCII de mesmo tamanho."""
+    arr = np.frombuffer("".join(cnpjs).encode("ascii"), dtype=np.uint8)
+    return arr.reshape(-1, largura).astype(np.int64) - ord("0")
+
+def _dvs_np(d12: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Os dois DVs de cada linha de um array (N, 12), via dois produtos matriz-vetor."""
+    r13 = (d12 @ _PESOS_12_NP) % 11
+    d13 = np.where(r13 < 2, 0, 11 - r13)
+    r14 = (d12 @ _PESOS_13_NP[:12] + d13 * _PESOS_13_NP[12]) % 11
+    d14 = np.where(r14 < 2, 0, 11 - r14)
+    return d13, d14
+
+def validar_cnpjs_lote(cnpjs_limpos: List[str]) -> np.ndarray:
+    """Versão vetorizada de cnpj_is_valid: uma máscara booleana para a lista inteira."""
+    ok = np.zeros(len(cnpjs_limpos), dtype=bool)
+    idx = [i for i, c in enumerate(cnpjs_limpos) if len(c) == 14 and c.isascii() and c.isdigit()]
+    if not idx:
+        return ok
+    arr = _digitos_np([cnpjs_limpos[i] for i in idx], 14)
+    d13, d14 = _dvs_np(arr[:, :12])
+    repetidos = (arr == arr[:, :1]).all(axis=1)
+    ok[idx] = (arr[:, 12] == d13) & (arr[:, 13] == d14) & ~repetidos
+    return ok
+
+def matrizes_lote(cnpjs_limpos: List[str]) -> List[str]:
+    """Versão em lote de to_matriz_if_filial: DVs das matrizes calculados numa passada só."""
+    out = list(cnpjs_limpos)
+    idx = [i for i, c in enumerate(out) if len(c) == 14 and c.isascii() and c.isdigit() and c[8:12] != "0001"]
+    if not idx:
+        return out
+    bases = [out[i][:8] + "0001" for i in idx]
+    d13, d14 = _dvs_np(_digitos_np(bases, 12))
+    for i, base, a, b in zip(idx, bases, d13.tolist(), d14.tolist()):
+        out[i] = f"{base}{a}{b}"
+    return out
+
+def _dv(digitos: List[int], pesos: Tuple[int, ...]) -> int:
+    r = sum(map(operator.mul, digitos, pesos)) % 11
+    return 0 if r < 2 else 11 - r
+
 def calcular_digitos_verificadores_cnpj(cnpj_base_12_digitos: str) -> str:
-    pesos_12 = [5,4,3,2,9,8,7,6,5,4,3,2]
-    pesos_13 = [6,5,4,3,2,9,8,7,6,5,4,3,2]
-    def dv(base, pesos):
-        s = sum(int(base[i]) * pesos[i] for i in range(len(base)))
-        r = s % 11
-        return '0' if r < 2 else str(11 - r)
-    d13 = dv(cnpj_base_12_digitos[:12], pesos_12)
-    d14 = dv(cnpj_base_12_digitos[:12] + d13, pesos_13)
-    return d13 + d14
+    digitos = list(map(int, cnpj_base_12_digitos[:12]))
+    d13 = _dv(digitos, _PESOS_12)
+    digitos.append(d13)
+    d14 = _dv(digitos, _PESOS_13)
+    return f"{d13}{d14}"
 
 def to_matriz_if_filial(cnpj_clean: str) -> str:
     if len(cnpj_clean) != 14:
@@ -157,15 +269,24 @@ def get_regime_tributario(regimes_list: Any) -> Tuple[str, str]:
     """
     if not isinstance(regimes_list, list) or not regimes_list:
         return "N/A", "N/A"
-    regimes_por_ano = {r.get('ano'): r.get('forma_de_tributacao') for r in regimes_list if isinstance(r, dict)}
+    # Uma passada só: ano mais recente (com forma) dentro dos últimos 5 anos;
+    # se não houver, o registro de ano mais alto da lista.
     current_year = datetime.datetime.now().year
-    for y in [current_year - i for i in range(6)]:
-        if y in regimes_por_ano and regimes_por_ano[y]:
-            return regimes_por_ano[y], str(y)
-    latest = max(
-        (r for r in regimes_list if isinstance(r, dict) and r.get('ano') is not None),
-        key=lambda x: x['ano'], default=None
-    )
+    recente = None
+    latest = None
+    for r in regimes_list:
+        if not isinstance(r, dict):
+            continue
+        y = r.get('ano')
+        if y is None:
+            continue
+        forma = r.get('forma_de_tributacao')
+        if forma and isinstance(y, int) and current_year - 5 <= y <= current_year and (recente is None or y >= recente[0]):
+            recente = (y, forma)
+        if latest is None or y > latest.get('ano'):
+            latest = r
+    if recente:
+        return recente[1], str(recente[0])
     if latest:
         return latest.get('forma_de_tributacao', "N/A"), str(latest.get('ano', "N/A"))
     return "N/A", "N/A"
@@ -200,9 +321,17 @@ def humanize_seconds(seconds: float) -> str:
     parts.append(f"{s}s")
     return " ".join(parts)
 
-def mk_job_id(cnpjs: List[str]) -> str:
-    base = "\n".join([limpar_cnpj(x) for x in cnpjs])
-    return hashlib.md5(base.encode("utf-8")).hexdigest()
+def mk_job_id(cnpjs_limpos: List[str]) -> str:
+    # Hash incremental (sem montar a string concatenada). Mantém o MD5 de
+    # "\n".join(...) para que os autosaves existentes continuem sendo retomados.
+    # Recebe CNPJs já limpos (limpar_cnpj é idempotente, então o hash não muda).
+    h = hashlib.md5()
+    sep = b""
+    for c in cnpjs_limpos:
+        h.update(sep)
+        h.update(c.encode("ascii"))
+        sep = b"\n"
+    return h.hexdigest()
 
 def mk_paths(job_id: str) -> Tuple[str, str]:
     os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -215,18 +344,74 @@ def mk_paths(job_id: str) -> Tuple[str, str]:
 # =========================
 @dataclass
 class AdaptiveLimiter:
+    """AIMD: aumento aditivo da taxa a cada janela de sucessos, redução multiplicativa
+    em 429/5xx/timeout. Também respeita pausas pedidas pelo servidor (Retry-After /
+    X-RateLimit-*), que valem para todos os workers, não só para quem recebeu o 429."""
     min_interval: float = START_INTERVAL
     last_request_ts: float = 0.0
     successes_since_last_adjust: int = 0
+    paused_until: float = 0.0
+    last_backoff: float = 0.0
+    # Timestamps internos (last_request_ts, paused_until) são de time.monotonic():
+    # um ajuste de relógio (NTP) não pode criar espera fantasma nem liberar rajada.
     def __post_init__(self):
         self._lock = threading.Lock()
     def wait_turn(self):
-        with self._lock:
-            now = time.time()
-            wait_for = (self.last_request_ts + self.min_interval) - now
+        # Reserva o próximo slot sob o lock e dorme fora dele: as esperas dos workers
+        # se sobrepõem e penalize()/reward() não ficam bloqueados atrás de um sleep.
+        # Ao acordar confere de novo: se uma pausa (pause_for) começou depois da reserva
+        # e o slot caiu dentro dela, reserva outro em vez de disparar durante a pausa.
+        slot = None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if slot is not None and slot >= self.paused_until:
+                    return
+                slot = max(now, self.last_request_ts + self.min_interval, self.paused_until)
+                self.last_request_ts = slot
+            wait_for = slot - now
             if wait_for > 0:
                 time.sleep(wait_for)
-            self.last_request_ts = time.time()
+    def pause_for(self, seconds: float):
+        with self._lock:
+            until = time.monotonic() + min(max(seconds, 0.0), MIN_INTERVAL_CEIL)
+            self.paused_until = max(self.paused_until, until)
+    def observe_headers(self, headers: Any) -> Optional[float]:
+        """Lê Retry-After / X-RateLimit-Remaining+Reset; aplica a pausa e devolve os segundos (ou None).
+        Com cota restante > 0, espalha os pedidos até o reset em vez de esperar o 429."""
+        wait = None
+        retry_after = headers.get("Retry-After")
+        if retry_after:
+            try:
+                wait = float(retry_after)
+            except ValueError:
+                wait = None
+        remaining = headers.get("X-RateLimit-Remaining")
+        if wait is None and remaining is not None:
+            try:
+                rem = int(remaining)
+                reset = float(headers.get("X-RateLimit-Reset", ""))
+                # Alguns servidores mandam epoch, outros segundos restantes
+                janela = reset - time.time() if reset > 1e9 else reset
+            except ValueError:
+                rem, janela = None, 0.0
+            if rem is not None and rem <= 0:
+                wait = janela
+            elif rem and janela > 0:
+                with self._lock:
+                    self.min_interval = max(self.min_interval, min(janela / rem, MIN_INTERVAL_CEIL))
+        if wait is not None and wait > 0:
+            self.pause_for(wait)
+            return wait
+        return None
+    def backoff_delay(self) -> float:
+        """Jitter descorrelacionado: sorteia entre a base e 3x a última espera. Os workers
+        compartilham a cota, então esperas fixas 1x/2x/4x voltariam todos juntos."""
+        with self._lock:
+            base = max(self.min_interval, 1.0)
+            delay = min(random.uniform(base, max(self.last_backoff, base) * 3), MIN_INTERVAL_CEIL)
+            self.last_backoff = delay
+        return delay
     def penalize(self):
         with self._lock:
             self.min_interval = min(self.min_interval * ADAPT_FAIL_BACKOFF, MIN_INTERVAL_CEIL)
@@ -234,23 +419,49 @@ class AdaptiveLimiter:
     def reward(self):
         with self._lock:
             self.successes_since_last_adjust += 1
+            self.last_backoff = 0.0
             if self.successes_since_last_adjust >= ADAPT_SUCC_WINDOW:
-                self.min_interval = max(self.min_interval * 0.85, MIN_INTERVAL_FLOOR)
+                rate = 1.0 / self.min_interval + ADAPT_RATE_STEP
+                self.min_interval = max(1.0 / rate, MIN_INTERVAL_FLOOR)
                 self.successes_since_last_adjust = 0
 
 # =========================
 # IBGE fallback (normalizado e cacheado por UF)
 # =========================
 _IBGE_CACHE: Dict[str, Dict[str, str]] = {}
+_IBGE_CHAVES: Dict[str, List[str]] = {}  # nomes normalizados ordenados, para busca por prefixo
+_IBGE_LOCK = threading.Lock()  # só protege _IBGE_LOCKS
+_IBGE_LOCKS: Dict[str, threading.Lock] = {}
+
+# Pontuação que separa palavras. Travessões (–, —) não entram: não sobrevivem à
+# passagem para ASCII abaixo, então nunca chegam aqui.
+_PONTUACAO = str.maketrans("-/\\,.", "     ")
 
 def _norm_txt(s: str) -> str:
     if not s:
         return ""
-    s = unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("ascii")
-    s = s.lower().strip()
-    for ch in ["-", "–", "—", "/", "\\", ",", "."]:
-        s = s.replace(ch, " ")
-    return " ".join(s.split())
+    if not s.isascii():
+        s = unicodedata.normalize("NFKD", s).encode("ascii", "ignore").decode("ascii")
+    return " ".join(s.lower().translate(_PONTUACAO).split())
+
+def _ibge_tabela_uf(uf: str) -> Dict[str, str]:
+    """{municipio_normalizado: codigo_ibge} da UF; baixado uma única vez por execução do
+    script (cada rerun recomeça vazio), mesmo com vários workers pedindo a mesma UF
+    ao mesmo tempo. O lock é por UF: um worker baixando SP não segura outro que
+    precisa de MG."""
+    tabela = _IBGE_CACHE.get(uf)
+    if tabela is None:
+        with _IBGE_LOCK:
+            lock_uf = _IBGE_LOCKS.setdefault(uf, threading.Lock())
+        with lock_uf:
+            tabela = _IBGE_CACHE.get(uf)
+            if tabela is None:
+                r = get_session().get(URL_IBGE_MUNS.format(uf=uf), timeout=10)
+                r.raise_for_status()
+                tabela = {_norm_txt(m["nome"]): str(m["id"]) for m in orjson.loads(r.content)}
+                _IBGE_CHAVES[uf] = sorted(tabela)
+                _IBGE_CACHE[uf] = tabela  # publicado por último: quem vê a tabela já vê as chaves
+    return tabela
 
 def get_ibge_code_by_uf_city(uf: str, municipio: str) -> str:
     try:
@@ -258,17 +469,22 @@ def get_ibge_code_by_uf_city(uf: str, municipio: str) -> str:
             return "N/A"
         uf = uf.strip().upper()
         m_norm = _norm_txt(municipio)
-        if uf not in _IBGE_CACHE:
-            url = URL_IBGE_MUNS.format(uf=uf)
-            r = requests.get(url, timeout=10)
-            r.raise_for_status()
-            _IBGE_CACHE[uf] = {_norm_txt(m["nome"]): str(m["id"]) for m in r.json()}
-        code = _IBGE_CACHE[uf].get(m_norm)
+        tabela = _ibge_tabela_uf(uf)
+        code = tabela.get(m_norm)
         if code:
             return code
-        for k, v in _IBGE_CACHE[uf].items():
-            if m_norm.startswith(k) or k.startswith(m_norm):
-                return v
+        if not m_norm:
+            return "N/A"
+        # Nome da tabela que é prefixo do informado: testa os prefixos do maior ao menor
+        for i in range(len(m_norm) - 1, 0, -1):
+            code = tabela.get(m_norm[:i])
+            if code:
+                return code
+        # Nome da tabela que começa com o informado: primeiro >= m_norm na lista ordenada
+        chaves = _IBGE_CHAVES[uf]
+        j = bisect.bisect_left(chaves, m_norm)
+        if j < len(chaves) and chaves[j].startswith(m_norm):
+            return tabela[chaves[j]]
         return "N/A"
     except Exception:
         return "N/A"
@@ -278,40 +494,35 @@ def get_ibge_code_by_uf_city(uf: str, municipio: str) -> str:
 # =========================
 RETRYABLE_STATUS = {429, 500, 502, 503, 504}
 
-def _sleep_backoff(base_min_interval: float, attempt: int) -> None:
-    base = max(base_min_interval, 1.0)
-    time.sleep(min(base * (2 ** (attempt - 1)) + random.uniform(0, 0.6), MIN_INTERVAL_CEIL))
+def _sleep_backoff(limiter: AdaptiveLimiter) -> None:
+    time.sleep(limiter.backoff_delay())
 
 def request_cnpj_with_retry(cnpj_query: str, limiter: AdaptiveLimiter) -> Tuple[Optional[Dict[str, Any]], str]:
     last_err = None
     sess = get_session()
-    for attempt in range(1, TOTAL_RETRIES + 1):
+    for _ in range(TOTAL_RETRIES):
         limiter.wait_turn()
         try:
-            resp = sess.get(f"{URL_BRASILAPI_CNPJ}{cnpj_query}", timeout=REQ_TIMEOUT)
+            resp = sess.get(URL_BRASILAPI_CNPJ + cnpj_query, timeout=REQ_TIMEOUT)
             if resp.status_code in RETRYABLE_STATUS:
                 limiter.penalize()
-                retry_after = resp.headers.get("Retry-After")
-                if retry_after:
-                    try:
-                        time.sleep(min(float(retry_after), MIN_INTERVAL_CEIL))
-                    except Exception:
-                        _sleep_backoff(limiter.min_interval, attempt)
-                else:
-                    _sleep_backoff(limiter.min_interval, attempt)
+                # Pausa pedida pelo servidor vale para todos; wait_turn() já a aplica
+                if limiter.observe_headers(resp.headers) is None:
+                    _sleep_backoff(limiter)
                 last_err = f"HTTP {resp.status_code}"
                 continue
             resp.raise_for_status()
-            data = resp.json()
+            data = orjson.loads(resp.content)  # bytes direto: sem detecção de charset nem json stdlib
+            limiter.observe_headers(resp.headers)
             limiter.reward()
             return data, None
         except requests.exceptions.Timeout:
-            limiter.penalize(); _sleep_backoff(limiter.min_interval, attempt); last_err = "Timeout"
+            limiter.penalize(); _sleep_backoff(limiter); last_err = "Timeout"
         except requests.exceptions.ConnectionError:
-            limiter.penalize(); _sleep_backoff(limiter.min_interval, attempt); last_err = "ConnectionError"
+            limiter.penalize(); _sleep_backoff(limiter); last_err = "ConnectionError"
         except requests.exceptions.HTTPError as e:
             try:
-                j = e.response.json()
+                j = orjson.loads(e.response.content)
                 msg = j.get("message") or j.get("type") or str(e)
             except Exception:
                 msg = str(e)
@@ -325,59 +536,86 @@ def request_cnpj_with_retry(cnpj_query: str, limiter: AdaptiveLimiter) -> Tuple[
 # =========================
 # Helpers de DataFrame (evitam ambiguidade com Series)
 # =========================
-def _col(df: pd.DataFrame, name: str) -> pd.Series:
-    """Retorna a coluna como string; se não existir, retorna série vazia do mesmo tamanho."""
-    if name in df.columns:
-        return df[name].astype(str)
-    return pd.Series([""] * len(df), index=df.index, dtype=str)
+def _mask_por_valor(df: pd.DataFrame, name: str, pred) -> np.ndarray:
+    """Avalia `pred` só nos valores distintos da coluna (factorize) e expande pelos códigos.
+    Colunas como 'MEI'/'Simples Nacional' têm 2-3 valores distintos, então isso troca
+    N operações de string por poucas. Coluna ausente ou NaN => False."""
+    if name not in df.columns:
+        return np.zeros(len(df), dtype=bool)
+    codes, uniques = pd.factorize(df[name])
+    lut = np.fromiter((pred(str(u)) for u in uniques), dtype=bool, count=len(uniques))
+    return np.append(lut, False)[codes]
 
 # =========================
 # Regras de regime + migração (PRIORIDADE MEI > Simples > NORMAL)
 # =========================
-def apply_regime_rules(df: pd.DataFrame) -> pd.DataFrame:
-    """Aplica a regra para TODAS as linhas: MEI > Simples > NORMAL."""
-    df = df.copy()
-    s = _col(df, "Simples Nacional").str.upper().str.strip().fillna("")
-    m = _col(df, "MEI").str.upper().str.strip().fillna("")
-    df["Regime Tributario"] = np.where(
-        m.eq("SIM"), "MEI",
-        np.where(s.eq("SIM"), "Simples", "NORMAL")
+_LUCRO_RE = re.compile(r"(?i)^lucro\s")
+
+def _regime_por_flags(df: pd.DataFrame) -> np.ndarray:
+    eh_sim = lambda v: v.strip().upper() == "SIM"
+    return np.select(
+        [_mask_por_valor(df, "MEI", eh_sim), _mask_por_valor(df, "Simples Nacional", eh_sim)],
+        ["MEI", "Simples"], default="NORMAL"
     )
-    return df
 
 def migrate_old_columns(df: pd.DataFrame) -> pd.DataFrame:
     """Migra CSV antigo:
        - cria 'Regime' (se faltar) e move valores 'Lucro ...' que estavam em 'Regime Tributario' antigo
        - recalcula 'Regime Tributario' pela regra MEI > Simples > NORMAL
        - garante colunas e ordem do layout
+    Altera `df` no lugar (os chamadores descartam o original); use o retorno.
     """
-    df = df.copy()
-
     if "Regime" not in df.columns:
         df["Regime"] = ""
 
-    rt_old = _col(df, "Regime Tributario")
-    mask_lucro = rt_old.str.contains(r"(?i)^lucro\s", na=False)
-    mask_regime_vazio = _col(df, "Regime").str.strip().eq("") | _col(df, "Regime").isna()
-    df.loc[mask_lucro & mask_regime_vazio, "Regime"] = rt_old[mask_lucro]
+    mask_lucro = _mask_por_valor(df, "Regime Tributario", lambda v: bool(_LUCRO_RE.match(v)))
+    mask_regime_vazio = _mask_por_valor(df, "Regime", lambda v: not v.strip()) | df["Regime"].isna().to_numpy()
+    mover = mask_lucro & mask_regime_vazio
+    if mover.any():
+        df.loc[mover, "Regime"] = df.loc[mover, "Regime Tributario"].astype(str)
 
     # aplica regra nova
-    df = apply_regime_rules(df)
+    df["Regime Tributario"] = _regime_por_flags(df)
 
     # garante todas as colunas do layout
     for col in CSV_COLS:
         if col not in df.columns:
             df[col] = ""
 
-    # reordena
-    df = df.reindex(columns=CSV_COLS)
+    # reordena (só se preciso: reindex sempre monta um frame novo)
+    if list(df.columns) != CSV_COLS:
+        df = df.reindex(columns=CSV_COLS)
     return df
 
+# Marcadores que o pd.read_csv (na_values padrão) lê como vazio ao reler o autosave
+_NA_CSV = [
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND",
+    "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+]
+
+def consolidado_de_linhas(rows: List[Dict[str, Any]]) -> pd.DataFrame:
+    """Frame das linhas em memória com as mesmas células que o autosave relido daria:
+    texto como o csv.writer grava (None -> "", resto str()), marcadores de NA do
+    read_csv como NaN e a mesma migrate_old_columns. Job novo e retomado exportam igual."""
+    df = pd.DataFrame(
+        [["" if r.get(k) is None else str(r.get(k)) for k in CSV_COLS] for r in rows],
+        columns=CSV_COLS, dtype=str,
+    )
+    return migrate_old_columns(df.mask(df.isin(_NA_CSV)))
+
 def ensure_autosave_header(csv_path: str, expected_cols: List[str]) -> None:
     """Garante header e migra dados antigos para o layout novo sem ambiguidade."""
     if not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0:
         pd.DataFrame(columns=expected_cols).to_csv(csv_path, sep=";", index=False, encoding="utf-8")
         return
+    # Header já no layout atual: nada a migrar, não reescreve o arquivo inteiro
+    try:
+        with open(csv_path, "r", encoding="utf-8", newline="") as f:
+            header = next(csv.reader(f, delimiter=";"), [])
+        if header == list(expected_cols):
+            return
+    except Exception:
+        pass
     try:
         df_old = pd.read_csv(csv_path, sep=";", dtype=str, encoding="utf-8")
         df_migr = migrate_old_columns(df_old)
@@ -394,31 +632,85 @@ def load_done_set(csv_path: str) -> Set[str]:
     done: Set[str] = set()
     if os.path.exists(csv_path):
         try:
-            df = pd.read_csv(csv_path, sep=";", dtype=str, encoding="utf-8")
-            col = "CNPJ_LIMPO" if "CNPJ_LIMPO" in df.columns else ("CNPJ" if "CNPJ" in df.columns else None)
-            if col:
-                done.update([limpar_cnpj(c) for c in df[col].dropna().astype(str).tolist()])
+            # Só uma coluna interessa: csv.reader (C) direto no arquivo, sem montar
+            # DataFrame. Respeita aspas, então ';' ou quebra de linha no endereço não
+            # desalinham as colunas.
+            with open(csv_path, "r", encoding="utf-8", newline="") as f:
+                rd = csv.reader(f, delimiter=";")
+                header = next(rd, [])
+                col = "CNPJ_LIMPO" if "CNPJ_LIMPO" in header else ("CNPJ" if "CNPJ" in header else None)
+                if col:
+                    i = header.index(col)
+                    done.update(limpar_cnpj(r[i]) for r in rd if len(r) > i and r[i])
         except Exception:
             pass
     return done
 
-# —— Escrita robusta com csv.DictWriter (layout CSV_COLS)
-def append_rows_csv(csv_path: str, rows: List[Dict[str, Any]]) -> int:
-    if not rows:
-        return 0
-    file_exists = os.path.exists(csv_path)
-    with open(csv_path, "a", encoding="utf-8", newline="") as f:
-        w = csv.DictWriter(f, fieldnames=CSV_COLS, delimiter=";", extrasaction="ignore")
-        if not file_exists:
-            w.writeheader()
-        for r in rows:
-            safe = {k: ("" if r.get(k) is None else str(r.get(k))) for k in CSV_COLS}
-            w.writerow(safe)
-    return len(rows)
+# —— Escrita robusta com csv.writer (layout CSV_COLS)
+class AutosaveCSV:
+    """Autosave aberto uma vez por lote: cada bloco é writerows + flush, sem open/close
+    por bloco. O flush mantém o arquivo em dia para a retomada se o processo cair."""
+    def __init__(self, csv_path: str):
+        novo = not os.path.exists(csv_path) or os.path.getsize(csv_path) == 0
+        self._f = open(csv_path, "a", encoding="utf-8", newline="", buffering=1 << 16)
+        self._w = csv.writer(self._f, delimiter=";")
+        if novo:
+            self._w.writerow(CSV_COLS)
+    def append_rows(self, rows: List[Dict[str, Any]]) -> int:
+        if not rows:
+            return 0
+        # Lista na ordem de CSV_COLS direto para o writer em C (None vira "", o resto
+        # passa por str()) — sem dict intermediário nem a remontagem do DictWriter
+        self._w.writerows([r.get(k) for k in CSV_COLS] for r in rows)
+        self._f.flush()
+        return len(rows)
+    @property
+    def tamanho_bytes(self) -> int:
+        # Modo "a" (O_APPEND): após o flush a posição é o fim do arquivo; tell() no
+        # próprio handle dispensa o stat por caminho a cada bloco
+        return self._f.tell()
+    def close(self) -> None:
+        self._f.close()
+    def __enter__(self) -> "AutosaveCSV":
+        return self
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+# —— Excel direto no xlsxwriter
+def excel_bytes(df: pd.DataFrame) -> bytes:
+    """XLSX linha a linha com write_row: sem o ExcelFormatter do pandas (que gera um
+    objeto por célula, coluna a coluna). Como as linhas saem em ordem, dá para usar
+    constant_memory e não manter a planilha inteira em memória. Texto vai como texto:
+    sem a regex de URL em cada célula e sem virar fórmula se começar com '='.
+    `df` já deve vir sem NaN (o consolidado é preenchido com "" antes de chegar aqui):
+    xlsxwriter não grava NaN."""
+    output = io.BytesIO()
+    wb = xlsxwriter.Workbook(output, {
+        "constant_memory": True,
+        "strings_to_urls": False,
+        "strings_to_formulas": False,
+        "strings_to_numbers": False,
+    })
+    ws = wb.add_worksheet("Resultados CNPJ")
+    ws.write_row(0, 0, list(df.columns), wb.add_format({"bold": True, "border": 1}))
+    for i, row in enumerate(df.itertuples(index=False, name=None), start=1):
+        ws.write_row(i, 0, row)
+    wb.close()
+    return output.getvalue()
+
+# Flags tri-estado da BrasilAPI (true/false/null) -> rótulo do CSV
+_TRI = {True: "SIM", False: "NÃO", None: "N/A"}
+
+def _tri(v: Any) -> str:
+    """Rótulo da flag; qualquer coisa que não seja bool/None (1, "S", lista...) vira N/A."""
+    return _TRI[v] if v is None or isinstance(v, bool) else "N/A"
 
 # =========================
 # Montagem de linha (sempre obedece CSV_COLS)
 # =========================
+# Linha de erro: tudo N/A exceto identificação, mensagem e timestamp (preenchidos por linha)
+_ROW_ERRO: Dict[str, Any] = dict.fromkeys(CSV_COLS, "N/A")
+_ROW_ERRO["Regime Tributario"] = "NORMAL"
 def montar_row(original_cnpj_str: str, cnpj_limpo: str,
                api_data: Optional[Dict[str, Any]], err_msg: Optional[str]) -> Dict[str, Any]:
     ts = datetime.datetime.now(BRASILIA_TZ).strftime("%Y-%m-%d %H:%M:%S")
@@ -428,12 +720,8 @@ def montar_row(original_cnpj_str: str, cnpj_limpo: str,
         simples_flag = api_data.get('opcao_pelo_simples')
         mei_flag     = api_data.get('opcao_pelo_mei')
 
-        if mei_flag:
-            regime_trib = "MEI"
-        elif simples_flag:
-            regime_trib = "Simples"
-        else:
-            regime_trib = "NORMAL"
+        # Mesma regra dos rótulos: só true conta (evita "MEI" com coluna MEI = N/A)
+        regime_trib = "MEI" if mei_flag is True else ("Simples" if simples_flag is True else "NORMAL")
 
         forma, ano = get_regime_tributario(api_data.get("regime_tributario", []))
         cnae_pri, cnae_sec = extrair_cnaes(api_data)
@@ -447,8 +735,9 @@ def montar_row(original_cnpj_str: str, cnpj_limpo: str,
         municipio = api_data.get("municipio", "N/A")
         uf = api_data.get("uf", "N/A")
 
-        ibge = api_data.get("municipio_ibge")
-        if ibge in (None, "", "0"):
+        # A BrasilAPI já devolve o código IBGE; a tabela do IBGE é só fallback
+        ibge = api_data.get("codigo_municipio_ibge") or api_data.get("municipio_ibge")
+        if ibge in (None, "", "0", 0):
             ibge = get_ibge_code_by_uf_city(uf, municipio)
 
         return {
@@ -461,8 +750,8 @@ def montar_row(original_cnpj_str: str, cnpj_limpo: str,
             "Regime Tributario": regime_trib,
             "Regime": forma,
             "Ano Regime Tributario": ano,
-            "Simples Nacional": "SIM" if simples_flag else ("NÃO" if simples_flag is False else "N/A"),
-            "MEI": "SIM" if mei_flag else ("NÃO" if mei_flag is False else "N/A"),
+            "Simples Nacional": _tri(simples_flag),
+            "MEI": _tri(mei_flag),
             "CNAE Principal": cnae_pri,
             "CNAE Secundario (primeiro)": cnae_sec,
             "Codigo IBGE Municipio": str(ibge) if ibge else "N/A",
@@ -470,24 +759,12 @@ def montar_row(original_cnpj_str: str, cnpj_limpo: str,
         }
 
     # Caso de erro (sem api_data): mantemos padrão seguro para layout
-    msg = err_msg or "Falha desconhecida"
-    return {
-        "CNPJ_ORIGINAL": original_cnpj_str,
-        "CNPJ_LIMPO": cnpj_limpo,
-        "Razao Social": msg,
-        "UF": 'N/A',
-        "Municipio": "N/A",
-        "Endereco": "N/A",
-        "Regime Tributario": 'NORMAL',
-        "Regime": 'N/A',
-        "Ano Regime Tributario": 'N/A',
-        "Simples Nacional": 'N/A',
-        "MEI": 'N/A',
-        "CNAE Principal": 'N/A',
-        "CNAE Secundario (primeiro)": 'N/A',
-        "Codigo IBGE Municipio": "N/A",
-        "TIMESTAMP": ts
-    }
+    row = _ROW_ERRO.copy()
+    row["CNPJ_ORIGINAL"] = original_cnpj_str
+    row["CNPJ_LIMPO"] = cnpj_limpo
+    row["Razao Social"] = err_msg or "Falha desconhecida"
+    row["TIMESTAMP"] = ts
+    return row
 
 def process_one_cnpj(original_cnpj_str: str, limiter: AdaptiveLimiter, force_matriz: bool) -> Dict[str, Any]:
     cleaned = limpar_cnpj(original_cnpj_str)
@@ -497,15 +774,13 @@ def process_one_cnpj(original_cnpj_str: str, limiter: AdaptiveLimiter, force_mat
     query_key = to_matriz_if_filial(cleaned) if force_matriz else cleaned
     cached = cache_get(query_key)
     if cached is not None:
-        out = dict(cached)
-        out["CNPJ_ORIGINAL"] = original_cnpj_str
-        out["CNPJ_LIMPO"] = cleaned
-        return out
+        return montar_row(original_cnpj_str, cleaned, cached, None)
 
     api_data, err_msg = request_cnpj_with_retry(query_key, limiter)
-    row = montar_row(original_cnpj_str, cleaned, api_data, err_msg)
-    cache_set(query_key, row)
-    return row
+    # só respostas válidas vão para o cache; erros são tentados de novo na próxima execução
+    if api_data and "cnpj" in api_data:
+        cache_set(query_key, api_data)
+    return montar_row(original_cnpj_str, cleaned, api_data, err_msg)
 
 # =========================
 # UI
@@ -531,13 +806,20 @@ if st.button("🔱 Consultar em Lote", help="Inicia a consulta com limiter adapt
     if not cnpjs_input.strip():
         st.warning("Por favor, insira os CNPJs para consultar."); st.stop()
 
-    raw = [x for x in re.split(r'[\n,;\s]+', cnpjs_input.strip()) if x]
+    raw = cnpjs_input.translate(_SEPARADORES).split()
     uniq_inputs = list(dict.fromkeys(raw))
     if len(uniq_inputs) > MAX_INPUTS:
         st.error(f"Você enviou {len(uniq_inputs)} entradas. O limite deste app é {MAX_INPUTS}."); st.stop()
 
-    # Normaliza para CNPJ limpo e descarta entradas vazias
-    normalized = [limpar_cnpj(x) for x in uniq_inputs if limpar_cnpj(x)]
+    # Uma passada: CNPJ limpo de cada entrada (com repetições, que entram no job_id)
+    # e o primeiro texto original de cada CNPJ limpo (ordem de entrada preservada)
+    normalized: List[str] = []
+    primeiro_original: Dict[str, str] = {}
+    for original in uniq_inputs:
+        c = limpar_cnpj(original)
+        if c:
+            normalized.append(c)
+            primeiro_original.setdefault(c, original)
     if not normalized:
         st.warning("Nenhuma entrada válida após normalização."); st.stop()
 
@@ -548,17 +830,13 @@ if st.button("🔱 Consultar em Lote", help="Inicia a consulta com limiter adapt
     ensure_autosave_header(csv_autosave, CSV_COLS)
 
     done_set = load_done_set(csv_autosave)  # já normalizado
+    historico_vazio = not done_set  # done_set cresce durante o lote; guarda o estado inicial
     to_do_orig: List[str] = []
-    seen_clean: Set[str] = set()
-
-    # Mapeia o primeiro texto original para cada CNPJ limpo
-    for original in uniq_inputs:
-        c = limpar_cnpj(original)
-        if not c or c in seen_clean:
-            continue
-        seen_clean.add(c)
+    to_do_clean: List[str] = []
+    for c, original in primeiro_original.items():
         if c not in done_set:
             to_do_orig.append(original)
+            to_do_clean.append(c)
 
     st.info(
         f"**Autosave** ativo em: `{csv_autosave}`  \n"
@@ -572,54 +850,95 @@ if st.button("🔱 Consultar em Lote", help="Inicia a consulta com limiter adapt
         st.write(f"Iniciando processamento de **{len(to_do_orig)}** CNPJs pendentes…")
         progress = st.progress(0)
         status_box = st.empty()
-        limiter_global = AdaptiveLimiter(min_interval=START_INTERVAL)
-
-        started_at = time.time()
+        autosave_box = st.empty()  # um único slot reaproveitado a cada bloco gravado
+        preview_box = st.empty()   # prévia das últimas linhas; a tabela completa só no fim
+        # Mesmo limiter entre execuções da sessão: o intervalo aprendido no lote anterior
+        # vale como ponto de partida, em vez de redescobrir o limite a cada clique.
+        limiter_global = st.session_state.setdefault("_limiter", AdaptiveLimiter(min_interval=START_INTERVAL))
+
+        started_at = time.monotonic()
+        wall_started_at = datetime.datetime.now(BRASILIA_TZ)  # base do horário previsto (relógio lido uma vez)
         buffer_rows: List[Dict[str, Any]] = []
         total_this_run = len(to_do_orig)
         processed_now = 0
+        last_ui_ts = 0.0
 
         def _mark_done_from_rows(rows: List[Dict[str, Any]]):
+            # CNPJ_LIMPO já sai limpo de montar_row: não passa por limpar_cnpj de novo
             for r in rows:
-                c14 = limpar_cnpj(r.get("CNPJ_LIMPO",""))
+                c14 = r.get("CNPJ_LIMPO")
                 if c14:
                     done_set.add(c14)
 
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-            fut_map = {ex.submit(process_one_cnpj, cnpj_str, limiter_global, force_matriz): cnpj_str for cnpj_str in to_do_orig}
-            for fut in as_completed(fut_map):
-                row = fut.result()
+        def _render_andamento(now: float):
+            elapsed = now - started_at
+            remaining_now = total_this_run - processed_now
+            eff_rate = processed_now / elapsed if elapsed > 0 else 0.0
+            eta_sec = remaining_now / eff_rate if eff_rate > 0 else 0
+            finish_time = wall_started_at + datetime.timedelta(seconds=int(elapsed + eta_sec))
+            progress.progress(processed_now / max(total_this_run, 1))
+            status_box.info(
+                f"📊 **Andamento:** {processed_now} de {total_this_run} CNPJs  \n"
+                f"⚡ **Velocidade:** ~{eff_rate:.2f} CNPJs/seg  \n"
+                f"⏳ **Tempo restante:** {humanize_seconds(eta_sec)}  \n"
+                f"🕒 **Previsão de término:** {finish_time.strftime('%H:%M:%S')}"
+            )
+
+        # DV validado em lote: inválidos viram linha na hora, sem ocupar worker nem limiter.
+        # Os válidos são agrupados por chave de consulta: com "Forçar Matriz", filiais da
+        # mesma raiz viram uma única requisição e o resultado é replicado para cada entrada.
+        dv_ok = validar_cnpjs_lote(to_do_clean)
+        query_keys = matrizes_lote(to_do_clean) if force_matriz else to_do_clean
+        grupos: Dict[str, List[Tuple[str, str]]] = {}
+        for original, c, query_key, ok in zip(to_do_orig, to_do_clean, query_keys, dv_ok):
+            if not ok:
+                row = montar_row(original, c, None, "CNPJ inválido (DV)")
                 buffer_rows.append(row)
                 all_rows_this_run.append(row)
                 processed_now += 1
-
-                # Autosave por bloco (layout sempre CSV_COLS)
-                if len(buffer_rows) >= AUTOSAVE_BLOCK:
-                    written = append_rows_csv(csv_autosave, buffer_rows)
-                    size_kb = os.path.getsize(csv_autosave) / 1024 if os.path.exists(csv_autosave) else 0
-                    st.caption(f"🔸 Autosave: gravadas **{written}** linhas (arquivo ~{size_kb:.1f} KB).")
-                    _mark_done_from_rows(buffer_rows)
-                    buffer_rows.clear()
-
-                # Status amigável
-                elapsed = time.time() - started_at
-                remaining_now = total_this_run - processed_now
-                eff_rate = processed_now / elapsed if elapsed > 0 else 0.0
-                eta_sec = remaining_now / eff_rate if eff_rate > 0 else 0
-                finish_time = datetime.datetime.now(BRASILIA_TZ) + datetime.timedelta(seconds=int(eta_sec))
-                progress.progress(processed_now / max(total_this_run, 1))
-                status_box.info(
-                    f"📊 **Andamento:** {processed_now} de {total_this_run} CNPJs  \n"
-                    f"⚡ **Velocidade:** ~{eff_rate:.2f} CNPJs/seg  \n"
-                    f"⏳ **Tempo restante:** {humanize_seconds(eta_sec)}  \n"
-                    f"🕒 **Previsão de término:** {finish_time.strftime('%H:%M:%S')}"
-                )
-
-        # Flush final
-        if buffer_rows:
-            written = append_rows_csv(csv_autosave, buffer_rows)
-            size_kb = os.path.getsize(csv_autosave) / 1024 if os.path.exists(csv_autosave) else 0
-            st.caption(f"🔸 Autosave (final): gravadas **{written}** linhas (arquivo ~{size_kb:.1f} KB).")
+                continue
+            grupos.setdefault(query_key, []).append((original, c))
+
+        with AutosaveCSV(csv_autosave) as autosave:
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+                fut_map = {ex.submit(process_one_cnpj, membros[0][0], limiter_global, force_matriz): membros for membros in grupos.values()}
+                for fut in as_completed(fut_map):
+                    row0 = fut.result()
+                    rows = [row0] + [dict(row0, CNPJ_ORIGINAL=o, CNPJ_LIMPO=c) for o, c in fut_map[fut][1:]]
+                    buffer_rows.extend(rows)
+                    all_rows_this_run.extend(rows)
+                    processed_now += len(rows)
+
+                    # Autosave por bloco (layout sempre CSV_COLS)
+                    if len(buffer_rows) >= AUTOSAVE_BLOCK:
+                        written = autosave.append_rows(buffer_rows)
+                        size_kb = autosave.tamanho_bytes / 1024
+                        autosave_box.caption(f"🔸 Autosave: gravadas **{written}** linhas (arquivo ~{size_kb:.1f} KB).")
+                        _mark_done_from_rows(buffer_rows)
+                        buffer_rows.clear()
+
+                    # Status amigável (no máximo ~2x/s: cada escrita em widget é um envio ao navegador)
+                    now = time.monotonic()
+                    if now - last_ui_ts < UI_REFRESH_SECONDS and processed_now < total_this_run:
+                        continue
+                    last_ui_ts = now
+                    _render_andamento(now)
+                    preview_box.dataframe(
+                        pd.DataFrame.from_records(all_rows_this_run[-PREVIEW_TAIL_ROWS:], columns=CSV_COLS),
+                        use_container_width=True,
+                    )
+
+            # Estado final sempre desenhado: se todos forem DV inválido, `grupos` fica vazio
+            # e o laço acima nem roda
+            _render_andamento(time.monotonic())
+            preview_box.empty()
+
+            # Flush final
+            if buffer_rows:
+                written = autosave.append_rows(buffer_rows)
+                size_kb = autosave.tamanho_bytes / 1024
+                autosave_box.caption(f"🔸 Autosave (final): gravadas **{written}** linhas (arquivo ~{size_kb:.1f} KB).")
+                _mark_done_from_rows(buffer_rows)
 
         st.success(f"Concluído! Total geral no autosave: **{len(done_set)}** CNPJs (normalizados).")
 
@@ -628,30 +947,49 @@ if st.button("🔱 Consultar em Lote", help="Inicia a consulta com limiter adapt
     st.subheader("Resultados (consolidados do autosave)")
 
     df_full = pd.DataFrame(columns=CSV_COLS)
-    if os.path.exists(csv_autosave):
+    if historico_vazio and all_rows_this_run:
+        # Job novo: o autosave tem exatamente as linhas desta execução, na mesma ordem;
+        # monta direto dos dicts em vez de reler e reparsear o CSV recém-gravado
+        df_full = consolidado_de_linhas(all_rows_this_run)
+    elif os.path.exists(csv_autosave):
         try:
             df_full = pd.read_csv(csv_autosave, sep=";", dtype=str, encoding="utf-8")
             # MIGRA/SANEIA novamente por garantia e já aplica regra
             df_full = migrate_old_columns(df_full)
         except Exception as e:
             st.warning(f"Não consegui ler o autosave agora ({e}). Vou mostrar o que foi obtido nesta execução.")
-            df_full = pd.DataFrame(all_rows_this_run, columns=CSV_COLS)
+            df_full = consolidado_de_linhas(all_rows_this_run)
 
     if df_full.empty and all_rows_this_run:
-        df_full = pd.DataFrame(all_rows_this_run, columns=CSV_COLS)
+        df_full = consolidado_de_linhas(all_rows_this_run)
 
-    st.dataframe(df_full.fillna(""), use_container_width=True)
+    # Vazios viram "" uma vez só, no próprio frame: tabela, CSV e Excel usam o mesmo
+    # objeto, sem uma cópia preenchida para cada um
+    df_full.fillna("", inplace=True)
+    st.dataframe(df_full, use_container_width=True)
 
     if not df_full.empty:
         timestamp = datetime.datetime.now(BRASILIA_TZ).strftime("%Y%m%d_%H%M%S")
+        col_csv, col_xlsx = st.columns(2)
+        # CSV é o download principal: sai direto do DataFrame, sem a serialização
+        # célula a célula do Excel
+        col_csv.download_button(
+            label="📥 Baixar CSV (consolidado)",
+            data=df_full.to_csv(sep=";", index=False).encode("utf-8-sig"),
+            file_name=f"CNPJ_PriceTax_{timestamp}.csv",
+            mime="text/csv",
+            on_click="ignore",
+            type="primary",
+            help="Mais rápido para lotes grandes; abre no Excel (separador ;)"
+        )
         excel_filename = f"CNPJ_PriceTax_{timestamp}.xlsx"
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-            df_full.to_excel(writer, index=False, sheet_name='Resultados CNPJ')
-        st.download_button(
+        # Excel gerado só no clique (callable), em thread separada; "ignore" evita o
+        # rerun que apagaria os resultados da tela
+        col_xlsx.download_button(
             label="📥 Baixar Excel (consolidado)",
-            data=output.getvalue(),
+            data=lambda: excel_bytes(df_full),
             file_name=excel_filename,
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            on_click="ignore",
             help="Clique para baixar os resultados em .xlsx"
         )